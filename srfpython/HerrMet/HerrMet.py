@@ -16,8 +16,6 @@ from srfpython.HerrMet.plugins import target, param, send, run, \
     manage, extract, display, optimize, default
 from srfpython.HerrMet.files import DEFAULTROOTNAMES
 
-check_herrmann_codes()
-
 # -------------------------------------
 from srfpython.version import __version__ as version
 default_verbose = 1
@@ -89,6 +87,10 @@ help = '''HerrMet {version}
 # -------------------------------------
 if __name__ == "__main__":
 
+    # run the Herrmann codes once here rather than at import
+    # (the module may be imported again by the workers)
+    check_herrmann_codes()
+
     argv = readargv1()
     # ------------------------------------- NO ARGUMENT, NAIVE CALL
     if argv == {}:
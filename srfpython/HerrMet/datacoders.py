@@ -111,3 +111,22 @@ def makedatacoder(surf96filename, which=Datacoder_log):
 
     waves, types, modes, freqs, values, dvalues = s.wtmfvd()
     return which(waves, types, modes, freqs, values, dvalues)
+
+
+def makedatacoders_from_arrays(Nobs, waves, types, modes, freqs, values, dvalues, which=Datacoder_log):
+    """
+    :param Nobs: number of dispersion points of each dataset
+    :type Nobs: array
+    :param waves, types, modes, freqs, values, dvalues: the dispersion points of all the datasets, one after the other
+    :type waves, types, modes, freqs, values, dvalues: arrays
+    :param which: which datacoder to use
+    :type which: type
+    :return datacoders: one datacoder object per dataset, no surf96 string to parse
+    :rtype datacoders: list
+    """
+    if not isinstance(which, type):
+        raise TypeError("which must be the class of the datacoder to use")
+
+    sections = np.cumsum(Nobs)[:-1]
+    arrays = [np.split(array, sections) for array in (waves, types, modes, freqs, values, dvalues)]
+    return [which(*dataset) for dataset in zip(*arrays)]
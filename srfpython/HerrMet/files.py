@@ -39,6 +39,8 @@ HERRMETOPTIMIZEPARAMFILE = '_HerrMet.optimize.param'
 HERRMETOPTIMIZEPRIORFILE = '_HerrMet.mprior.npz'
 HERRMETOPTIMIZEDOBSFILE = '_HerrMet.dobs.npz'
 HERRMETOPTIMIZEINVFILE = '_HerrMet.inv.npz'
+# cache of the theory operators built by optimize -inv, reused while the inputs do not change
+HERRMETOPTIMIZETHEORYSFILE = '_HerrMet.theorys.pkl'
 
 # the rootnames to use as default in several plugins
 DEFAULTROOTNAMES = os.path.dirname(HERRMETTARGETFILE.format(rootname=ROOTNAME.format(node="*")))
@@ -1,4 +1,11 @@
 import warnings
+import os
+import hashlib
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+from multiprocessing import cpu_count, Array
 import numpy as np
 import matplotlib.pyplot as plt
 from srfpython.standalone.stdout import waitbarpipe
@@ -6,36 +13,106 @@ from srfpython.standalone.multipro8 import Job, MapAsync
 from srfpython.HerrMet.theory import Theory
 from srfpython.depthdisp.dispcurves import surf96reader_from_arrays
 from srfpython.HerrMet.paramfile import load_paramfile
-from srfpython.HerrMet.datacoders import Datacoder_log, makedatacoder
 from srfpython.standalone.multipro8 import Job, MapSync, MapAsync
 from srfpython.standalone.stdout import waitbarpipe
 from srfpython.utils import Timer
+from srfpython.version import __version__
 import scipy.sparse as sp
 from scipy.sparse import linalg as splinalg
 
 
 # ========== g
+# the nodes are sent to the workers by batches (see ForwardOperator.node_batches)
+# several batches per worker so that a slow batch does not leave the other workers idle
+BATCHES_PER_WORKER = 4
+# the batch size is bounded so that the workers report their progress regularly on large grids
+MAX_NODES_PER_BATCH = 128
+
+# increment when the content of the theorys cache file changes
+THEORYS_CACHE_VERSION = 1
+
+
+def theorys_key(parameterizer_strings, datacoders, shape, **settings):
+    """a key to identify the inputs used to build the theorys of a ForwardOperator
+    :param shape: (nz, ny, nx), the grid of the ForwardOperator
+    :param settings: the keyword arguments passed to Theory
+    :return key: str, the hash of the cache format, the code version, the grid shape, the theory settings,
+        the parameterizer strings and the datacoder arrays
+    """
+    h = hashlib.sha1()
+    h.update("{} {} {} {}".format(
+        THEORYS_CACHE_VERSION, __version__, tuple(shape), sorted(settings.items())).encode())
+    for parameterizer_string, datacoder in zip(parameterizer_strings, datacoders):
+        h.update(np.asarray(parameterizer_string).tobytes())
+        h.update(datacoder.__class__.__name__.encode())
+        for array in (datacoder.waves, datacoder.types, datacoder.modes,
+                      datacoder.freqs, datacoder.values, datacoder.dvalues):
+            h.update(np.ascontiguousarray(array).tobytes())
+    return h.hexdigest()
+
+
 class ForwardOperator(object):
 
     def __init__(self,
-                 parameterizer_strings, datacoder_strings,
+                 parameterizer_strings, datacoders,
                  nx, ny, nz, Nobs,
-                 verbose=True, **mapkwargs):
-
+                 verbose=True, cachefile=None, h=0.005, ddc=0.005, **mapkwargs):
+        """
+        :param cachefile: name of a file where to save the theorys,
+            they are loaded from it instead of being built again if the inputs and settings are the same
+        :param h, ddc: passed to Theory
+        """
+
+        # the mappers and the batch size must use the same number of workers
+        if mapkwargs.get('Nworkers') is None:
+            mapkwargs['Nworkers'] = cpu_count()
         self.mapkwargs = mapkwargs
+        self.h, self.ddc = h, ddc
         self.nx, self.ny, self.nz = nx, ny, nz
         self.Nobs = Nobs  # number of dispersion point per node of the grid
+        self.data_offsets = np.concatenate(([0], np.cumsum(Nobs)))  # position of the first datum of each node
+
+        # number of nodes handled by each job in __call__ and frechet_derivatives
+        # large enough to amortize the communication cost, small enough to keep all the workers busy
+        self.nnode_per_job = int(np.clip(
+            nx * ny // (BATCHES_PER_WORKER * mapkwargs['Nworkers']),
+            1, MAX_NODES_PER_BATCH))
+
+        if cachefile is None:
+            self.theorys = self.build_theorys(parameterizer_strings, datacoders, verbose=verbose)
 
+        else:
+            key = theorys_key(parameterizer_strings, datacoders, shape=(nz, ny, nx), h=h, ddc=ddc)
+            self.theorys = None
+            if os.path.isfile(cachefile):
+                try:
+                    with open(cachefile, 'rb') as fid:
+                        cached_key, theorys = pickle.load(fid)
+                except Exception as e:
+                    # truncated file, or written by a version with other classes...
+                    warnings.warn('could not load {} ({!r}), the theorys will be built again'.format(cachefile, e))
+                else:
+                    if cached_key == key:
+                        self.theorys = theorys
+
+            if self.theorys is None:
+                self.theorys = self.build_theorys(parameterizer_strings, datacoders, verbose=verbose)
+                with open(cachefile, 'wb') as fid:
+                    pickle.dump((key, self.theorys), fid, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def build_theorys(self, parameterizer_strings, datacoders, verbose=True):
+        """build the theory of each node
+        :return theorys: object array, config = y, x
+        """
         def job_generator():
-            ls = zip(parameterizer_strings, datacoder_strings)
-            for nnode, (ps, ds) in enumerate(ls):
-                yield Job(nnode, parameterizer_string=ps, datacoder_string=ds)
+            ls = zip(parameterizer_strings, datacoders)
+            for nnode, (ps, dc) in enumerate(ls):
+                yield Job(nnode, parameterizer_string=ps, datacoder=dc)
 
-        def job_handler(nnode, parameterizer_string, datacoder_string):
+        def job_handler(nnode, parameterizer_string, datacoder):
             parameterizer = load_paramfile(parameterizer_string, verbose=False)[0]
-            datacoder = makedatacoder(datacoder_string, which=Datacoder_log)
 
-            theory = Theory(parameterizer=parameterizer, datacoder=datacoder)
+            theory = Theory(parameterizer=parameterizer, datacoder=datacoder, h=self.h, ddc=self.ddc)
 
             return nnode, theory
 
@@ -54,97 +131,106 @@ class ForwardOperator(object):
         if verbose:
             wb.close()
 
-        self.theorys = np.array(theorys, dtype=object).reshape((ny, nx))
+        return np.array(theorys, dtype=object).reshape((self.ny, self.nx))
+
+    def node_batches(self):
+        """group the nodes into jobs of self.nnode_per_job nodes
+        the jobs only carry node numbers (nnode = iy * nx + jx),
+        the theorys and models are forked with the workers
+        and the results are written in arrays shared between the workers (see MapAsync)
+        :yield: Job(nnode_begin, nnode_end) for each batch of nodes
+        """
+        nnode = self.nx * self.ny
+        for nnode_begin in range(0, nnode, self.nnode_per_job):
+            nnode_end = min(nnode_begin + self.nnode_per_job, nnode)
+            yield Job(nnode_begin, nnode_end)
 
     def __call__(self, M, verbose=True):
         nx, ny, nz = self.nx, self.ny, self.nz
         Nobs = self.Nobs
-
-        M = M.reshape((nz, ny, nx))
-        theorys = self.theorys
-
-        def job_generator():
-            for iy in range(ny):
-                for jx in range(nx):  # order matters!!!!
-                    nnode = iy * nx + jx
-                    yield Job(nnode, theorys[iy, jx], M[:, iy, jx])
-
-        def job_handler(nnode, theory, m):
-            data = theory(m=m)
-            return nnode, data
+        data_offsets = self.data_offsets
+        # in the memory of the workers, see self.node_batches
+        theorys = self.theorys.ravel()
+        ms = M.reshape((nz, ny * nx)).T  # ms[nnode] = model of node nnode
+
+        def job_handler(worker, nnode_begin, nnode_end):
+            # each job writes the data of its nodes in its own section of the shared array
+            Data = np.frombuffer(worker.parent.Data.get_obj())
+            Data[data_offsets[nnode_begin]: data_offsets[nnode_end]] = np.concatenate(
+                [theory(m=m) for theory, m in zip(theorys[nnode_begin:nnode_end], ms[nnode_begin:nnode_end])])
+            return nnode_begin, nnode_end
 
         wb = None
         if verbose:
             wb = waitbarpipe('g(m)')
 
-        Data = np.zeros(Nobs.sum(), float)
-        with MapAsync(job_handler, job_generator(), **self.mapkwargs) as ma:
-
-            for nnode, (nnode, data), _, _ in ma:
-                ib = Nobs[:nnode].sum()
-                ie = ib + Nobs[nnode]
-
-                Data[ib: ie] = data
+        shared_data = Array('d', int(Nobs.sum()))
+        ndone = 0
+        with MapAsync(job_handler, self.node_batches(),
+                      SharedVariables={"Data": shared_data}, **self.mapkwargs) as ma:
 
+            for _, (nnode_begin, nnode_end), _, _ in ma:
+                ndone += nnode_end - nnode_begin
                 if verbose:
-                    wb.refresh(nnode / float(nx * ny))
+                    wb.refresh(ndone / float(nx * ny))
 
         if verbose:
             wb.close()
 
+        Data = np.frombuffer(shared_data.get_obj())
         return Data  # warning : Data means encoded data
 
     def frechet_derivatives(self, M, verbose=True):
         nx, ny, nz = self.nx, self.ny, self.nz
         Nobs = self.Nobs
-
-        M = M.reshape((nz, ny, nx))
-        theorys = self.theorys
-
-        def job_generator():
-            for iy in range(ny):
-                for jx in range(nx): # order matters!!!!
-                    nnode = iy * nx + jx
-                    yield Job(nnode, theorys[iy, jx], M[:, iy, jx])
-
-        def job_handler(nnode, theory, m):
-            fd = theory.frechet_derivatives(m=m)
-            return nnode, fd
+        # in the memory of the workers, see self.node_batches
+        theorys = self.theorys.ravel()
+        ms = M.reshape((nz, ny * nx)).T  # ms[nnode] = model of node nnode
+
+        # G is block diagonal up to a permutation of the columns :
+        # node nnode = iy * nx + ix maps its nz parameters (columns iz * nx * ny + nnode)
+        # to its own Nobs[nnode] data (rows data_offsets[nnode]:data_offsets[nnode+1])
+        # => each column holds the derivatives of one node for one depth, fill the csc arrays directly
+        data_offsets = self.data_offsets
+        column_sizes = np.tile(Nobs, nz)
+        indptr = np.concatenate(([0], np.cumsum(column_sizes)))
+        column_starts = indptr[:-1].reshape((nz, ny * nx))  # position of the first item of each column
+
+        # the row numbers do not depend on the derivatives
+        column_first_rows = np.tile(data_offsets[:-1], nz)
+        indices = np.repeat(column_first_rows - indptr[:-1], column_sizes) + np.arange(indptr[-1])
+
+        # data numbers, built once for all the nodes and sliced to the size of each node
+        idas = np.arange(Nobs.max())
+
+        def job_handler(worker, nnode_begin, nnode_end):
+            # each job writes the derivatives of its nodes at their own positions in the shared array
+            dats = np.frombuffer(worker.parent.dats.get_obj())
+            for nnode in range(nnode_begin, nnode_end):
+                fd = theorys[nnode].frechet_derivatives(m=ms[nnode])
+                # positions of the derivatives in the csc arrays, iz = depth number, ida = data number
+                I = column_starts[:, nnode, np.newaxis] + idas[:Nobs[nnode]]  # I[iz, ida]
+                dats[I] = fd.T
+            return nnode_begin, nnode_end
 
         wb = None
         if verbose:
             wb = waitbarpipe('dg/dm(m)')
 
-        # FDs = []
-        rows = []
-        cols = []
-        dats = []
-        with MapSync(job_handler, job_generator(), **self.mapkwargs) as ma:  # order matters
-            for jobid, (nnode, fd), _, _ in ma:
-                # FDs.append(fd)
-                iy = nnode // nx  # line number of the node in the surface plane = "latitude number"
-                ix = nnode % nx  # column number of the node in the surface plane = "longitude number"
-
-                # _cols, _rows = np.meshgrid(np.arange(nz), np.arange(nper))
-                # cols += list(nnode * nz + _cols.flat[:])
-                # rows += list(nnode * nper + _rows.flat[:])
-
-                # iz = depth number
-                iz, ida = np.meshgrid(np.arange(nz), np.arange(Nobs[nnode]))
-                # convert indexs into positions in the model (_cols) ad data (_rows) spaces
-                _cols = iz.flat[:] * (nx * ny) + iy * nx + ix
-                _rows = list(Nobs[:nnode].sum() + ida.flat[:])
-                rows += list(_rows)
-                cols += list(_cols)
-                dats += list(fd.flat[:])
-
+        shared_dats = Array('d', int(indptr[-1]))
+        ndone = 0
+        with MapAsync(job_handler, self.node_batches(),
+                      SharedVariables={"dats": shared_dats}, **self.mapkwargs) as ma:
+            for _, (nnode_begin, nnode_end), _, _ in ma:
+                ndone += nnode_end - nnode_begin
                 if verbose:
-                    wb.refresh(nnode / float(nx * ny))
+                    wb.refresh(ndone / float(nx * ny))
 
         if verbose:
             wb.close()
 
-        G = sp.csc_matrix((dats, (rows, cols)), shape=(Nobs.sum(), nz * ny * nx), dtype=float)
+        dats = np.frombuffer(shared_dats.get_obj())
+        G = sp.csc_matrix((dats, indices, indptr), shape=(Nobs.sum(), nz * ny * nx), dtype=float)
         # plt.figure()
         # plt.imshow(G.A)
         # plt.show()
@@ -191,9 +277,10 @@ class ModelSmoother(object):
         iy = np.abs(y - yflat[i]) < trunc * Lh
         iz = np.abs(zmid - zflat[i]) < trunc * Lv
 
-        I = np.arange(nz * ny * nx).reshape((nz, ny, nx))[iz, ...][:, iy, :][..., ix].flat[:]
+        # flat positions of the selected nodes in the model (config = z, y, x), no need for a cube of indexs
+        I = np.ravel_multi_index(np.ix_(iz, iy, ix), (nz, ny, nx)).ravel()
 
-        cols = np.arange(self.shape[1])[I]
+        cols = I
         rows = i * np.ones_like(cols)
 
         d2norm = (np.abs(xflat[I] - xflat[i]) / Lh) ** 2.0 \
@@ -279,9 +366,10 @@ class ModelCovarianceMatrix(ModelSmoother):
         iy = np.abs(y - yflat[i]) < trunc * Lh
         iz = np.abs(zmid - zflat[i]) < trunc * Lv
 
-        I = np.arange(nz * ny * nx).reshape((nz, ny, nx))[iz, ...][:, iy, :][..., ix].flat[:]
+        # flat positions of the selected nodes in the model (config = z, y, x), no need for a cube of indexs
+        I = np.ravel_multi_index(np.ix_(iz, iy, ix), (nz, ny, nx)).ravel()
 
-        cols = np.arange(self.shape[1])[I]
+        cols = I
         rows = i * np.ones_like(cols)
 
         d2norm = (np.abs(xflat[I] - xflat[i]) / Lh) ** 2.0 \
@@ -298,20 +386,20 @@ class ModelCovarianceMatrix(ModelSmoother):
                 yield Job(i)
 
         def job_handler(i):
-            _rows, _cols, _vals = self.sparse_row(i, trunc=trunc)
-            return _rows, _cols, _vals
+            # the row number is enough, no need to send back an array of rows
+            _, _cols, _vals = self.sparse_row(i, trunc=trunc)
+            return i, _cols, _vals
 
-        rows = []
-        cols = []
-        vals = []
+        # one job per row, store the rows in order and fill the csr arrays directly
+        cols = [None] * self.shape[0]
+        vals = [None] * self.shape[0]
         with MapAsync(job_handler, job_generator(), Nworkers=40) as ma:
-            for _, (_rows, _cols, _vals), _, _ in ma:
-                rows.append(_rows)
-                cols.append(_cols)
-                vals.append(_vals)
+            for _, (i, _cols, _vals), _, _ in ma:
+                cols[i] = _cols
+                vals[i] = _vals
 
-        rows = np.hstack(rows)
+        indptr = np.hstack((0, np.cumsum([len(_cols) for _cols in cols])))
         cols = np.hstack(cols)
         vals = np.hstack(vals)
 
-        return sp.csc_matrix((vals, (rows, cols)))
+        return sp.csr_matrix((vals, cols, indptr), shape=self.shape).tocsc()
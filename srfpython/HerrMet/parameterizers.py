@@ -3,7 +3,7 @@ from __future__ import print_function
 import numpy as np
 from srfpython.HerrMet.relation import Relation
 from srfpython.depthdisp.depthmodels import \
-    depthmodel1D, depthmodel_from_mod96, depthmodel_from_arrays, depthspace
+    depthmodel1D, depthmodel_from_mod96, depthmodel_from_arrays, depthspace, stairs_index
 from srfpython.standalone.asciifile import AsciiFile_fromstring
 R43 = np.sqrt(4. / 3.)
 
@@ -14,11 +14,33 @@ see theory.py
 # TODO : move the sections of files.write_default_paramfile into the subclass versions of this method
 
 
+def layer_keys(nlayer, names):
+    """build the names of all the parameters of a parameterizer,
+    the first name is for the depth of the top of layers 1 to nlayer-1 (e.g. -Z1, -Z2, ...),
+    the next ones are for the property of layers 0 to nlayer-1 (e.g. VS0, VS1, ...)
+    :param nlayer: int, number of layers
+    :param names: list of prefixes, e.g. ["-Z", "VS", "PR", "RH"]
+    :return: array of strings
+    """
+    layers = np.arange(nlayer).astype(str)
+    layers = layers.astype(layers.dtype.kind + str(len(layers[-1])))  # narrowest string type
+    keys = np.char.add(np.asarray(names)[:, np.newaxis], layers)
+    return np.concatenate((keys[0, 1:], keys[1:].ravel()))
+
+
 class Parameterizer(object):
     """the parameterizer object links the model array (m) to a set of variables that can
        be understood by the theory function (ZTOP, VP, VS, RH)
        this is the default class, methods must be overwritten by subclasses"""
 
+    # the attributes are known in advance (see __init__), no need for a __dict__
+    # subclasses must declare their own additional attributes in __slots__
+    __slots__ = (
+        'NLAYER', 'MDEFAULT', '_ZMDEFAULT', 'KEYS',
+        'IDXNOTLOCK', '_INOTLOCK', '_all_free', 'MINF', 'MSUP', 'MMEAN', 'MSTD',
+        'dz', 'dvp', 'dvs', 'dpr', 'drh', 'DELTAM',
+        '_keys', '_frechet_deltas', '_slice_z', '_slice_vs')
+
     def __init__(self, ascii_file):
         """
         :param ascii_file: an initialized AsciiFile of AsciiFile_fromstring with the parameters
@@ -40,9 +62,12 @@ class Parameterizer(object):
 
         self.NLAYER = None
         self.MDEFAULT = None
+        self._ZMDEFAULT = None  # [0., MDEFAULT], the surface depth followed by the default parameters
         self.KEYS = None
 
         self.IDXNOTLOCK = None
+        self._INOTLOCK = None  # the positions of the True values in self.IDXNOTLOCK
+        self._all_free = False  # True if all the values of self.IDXNOTLOCK are True
         self.MINF = None
         self.MSUP = None
         self.MMEAN = None
@@ -56,6 +81,23 @@ class Parameterizer(object):
         self.drh = 0.01    # g/cm3
         self.DELTAM = None
 
+        # masked versions of self.KEYS and self.DELTAM, computed on first call to keys and frechet_deltas
+        self._keys = None
+        self._frechet_deltas = None
+
+    def __getstate__(self):
+        # needed to pickle an object with __slots__ whatever the protocol
+        state = {}
+        for cls in type(self).__mro__:
+            for attr in getattr(cls, '__slots__', ()):
+                if hasattr(self, attr):
+                    state[attr] = getattr(self, attr)
+        return state
+
+    def __setstate__(self, state):
+        for attr, value in state.items():
+            setattr(self, attr, value)
+
     @staticmethod
     def check_parameter_file(ascii_file):
         """
@@ -75,8 +117,8 @@ class Parameterizer(object):
         if not len(ascii_file.data['KEY']) == len(np.unique(ascii_file.data['KEY'])):
             raise ValueError('there are repeated entries in column KEYS')
 
-        if np.any(ascii_file.data['VINF'] > ascii_file.data['VSUP']):
-            I = ascii_file.data['VINF'] > ascii_file.data['VSUP']
+        I = ascii_file.data['VINF'] > ascii_file.data['VSUP']
+        if I.any():
             error_message = ' VSUP cannot be lower than VINF\n'
             error_message += "KEY: "  + str(ascii_file.data['KEY'][I]) + "\n"
             error_message += "VINF: " + str(ascii_file.data['VINF'][I]) + "\n"
@@ -102,25 +144,29 @@ class Parameterizer(object):
         this method is the default behavior, to be customized in subclasses if needed
         """
 
-        Ztopsup, VPlow, VSlow, RHlow = self.inv(self.MINF)
-        Ztopinf, VPhgh, VShgh, RHhgh = self.inv(self.MSUP)
-        z = np.sort(np.unique(np.concatenate((Ztopinf, Ztopsup))))
+        (Ztopsup, Ztopinf), (VPlow, VPhgh), (VSlow, VShgh), (RHlow, RHhgh) = \
+            self._inv_batch(np.vstack((self.MINF, self.MSUP)))
+        z = np.union1d(Ztopinf, Ztopsup)
 
         # --------------------
-        def f(Zinf, Zsup, V, which):
-            v1 = depthmodel1D(Zinf, V).interp(z, interpmethod="stairs")
-            v2 = depthmodel1D(Zsup, V).interp(z, interpmethod="stairs")
-            return depthmodel1D(z, which(np.concatenate(([v1], [v2]), axis=0), axis=0))
+        # layer number of each depth z in both models, the same for all fields
+        iinf = stairs_index(Ztopinf, z)
+        isup = stairs_index(Ztopsup, z)
+
+        def f(V, which):
+            v1 = V[iinf]
+            v2 = V[isup]
+            return depthmodel1D(z, which(v1, v2))
 
         # --------------------
-        vplow = f(Ztopinf, Ztopsup, VPlow, np.min)
-        vphgh = f(Ztopinf, Ztopsup, VPhgh, np.max)
+        vplow = f(VPlow, np.minimum)
+        vphgh = f(VPhgh, np.maximum)
 
-        vslow = f(Ztopinf, Ztopsup, VSlow, np.min)
-        vshgh = f(Ztopinf, Ztopsup, VShgh, np.max)
+        vslow = f(VSlow, np.minimum)
+        vshgh = f(VShgh, np.maximum)
 
-        rhlow = f(Ztopinf, Ztopsup, RHlow, np.min)
-        rhhgh = f(Ztopinf, Ztopsup, RHhgh, np.max)
+        rhlow = f(RHlow, np.minimum)
+        rhhgh = f(RHhgh, np.maximum)
 
         prlow = depthmodel1D(z, vphgh.values / vslow.values)
         prhgh = depthmodel1D(z, vplow.values / vshgh.values)
@@ -131,17 +177,28 @@ class Parameterizer(object):
         """a method to provide the name of the inverted parameters
         return the masked version of the array, i.e. only the keys that
         are actually inverted (uses the boolean array self.IDXNOTLOCK)
-        :return: array or list of parameters
+        :return: array or list of parameters, read only
         """
-        return self.KEYS[self.IDXNOTLOCK]  # do not subclass
+        # do not subclass
+        if self._keys is None:
+            # KEYS and IDXNOTLOCK are not modified after __init__, compute once
+            self._keys = self.KEYS[self.IDXNOTLOCK]
+            self._keys.flags.writeable = False
+        return self._keys
 
     def frechet_deltas(self):
         """define the array offset values to use for each inverted parameter
         for the computation of the frechet derivatives
         :return deltam: the array of values to use for the perturbation of the model parameters
         dg/dm = (g(m + deltam) - g(m)) / deltam
+        the returned array is read only
         """
-        return self.DELTAM[self.IDXNOTLOCK]  # do not subclass
+        # do not subclass
+        if self._frechet_deltas is None:
+            # DELTAM and IDXNOTLOCK are not modified after __init__, compute once
+            self._frechet_deltas = self.DELTAM[self.IDXNOTLOCK]
+            self._frechet_deltas.flags.writeable = False
+        return self._frechet_deltas
 
     def __call__(self, ZTOP, VP, VS, RH):
         """the method that is called to convert
@@ -164,6 +221,41 @@ class Parameterizer(object):
         """
         raise NotImplementedError  # the default behavior, each subclass must define this method
 
+    def _fill(self, m):
+        """the first step of self.inv, shared by the subclasses
+        insert m in the full array of parameters and get the top depth of the layers
+        uses one new array per call, ZTOP and M are views of it
+        ZTOP is read directly in the array because the surface depth is stored first and
+        the interfaces (-Z) are negated in place
+        :param m: array of parameters (corresponding to self.IDXNOTLOCK),
+                  or 2D array with one array of parameters per line (see self._inv_batch)
+        :return ZTOP: the top depth of each layer (0 for the first one)
+        :return M: the full array of parameters, warning the depth parameters M[self._slice_z] are Z not -Z
+                   M may be longer than MDEFAULT if the subclass reserved room for other arrays in self._ZMDEFAULT
+        """
+        ZM = np.empty(np.shape(m)[:-1] + self._ZMDEFAULT.shape)
+        M = ZM[..., 1:]
+        if self._all_free:
+            # no default value to keep, m is the full array of parameters
+            ZM[..., 0] = 0.
+            M[..., :len(self.MDEFAULT)] = m
+        else:
+            ZM[...] = self._ZMDEFAULT
+            M[..., self._INOTLOCK] = m  # overwrites default values with the one provided in m
+
+        ZTOP = ZM[..., :self.NLAYER]
+        np.negative(ZTOP[..., 1:], out=ZTOP[..., 1:])
+        return ZTOP, M
+
+    def _inv_batch(self, ms):
+        """same as inv for several model arrays at once
+        :param ms: 2D array, one model array per line (corresponding to self.IDXNOTLOCK)
+        :return: 4 2D arrays ZTOP, VP, VS, RH, one depth model per line
+        this is the default behavior (one call to inv per line),
+        subclasses whose inv works along the last axis may process all the lines at once
+        """
+        return tuple(np.array(x) for x in zip(*[self.inv(m) for m in ms]))
+
     def inv_to_depthmodel(self, m):
         """same as inv but pack output into a depthmodel object
         do not subclass"""
@@ -192,59 +284,73 @@ class Parameterizer(object):
 
 
 class Parameterizer_mZVSPRRH(Parameterizer):
+    __slots__ = ('_slice_pr', '_slice_rh', '_slice_vpout')
 
     def __init__(self, ascii_file):
         """see Parameterizer"""
 
         Parameterizer.__init__(self, ascii_file=ascii_file)
+        # VINF <= VSUP already checked by check_parameter_file
+        # read the columns once, as contiguous float arrays (the arrays derived from them will be too)
+        VINF = np.ascontiguousarray(ascii_file.data['VINF'], dtype=np.float64)
+        VSUP = np.ascontiguousarray(ascii_file.data['VSUP'], dtype=np.float64)
 
         assert ascii_file.metadata['TYPE'] == "mZVSPRRH"
-        assert np.all(ascii_file.data['VINF'] <= ascii_file.data['VSUP'])
-        if np.all(ascii_file.data['VINF'] == ascii_file.data['VSUP']):
+        if np.all(VINF == VSUP):
             print("Warning : all parameters are locked")
 
         self.NLAYER = ascii_file.metadata['NLAYER']
-        self.KEYS = np.hstack((
-            ["-Z%d" % i for i in range(1, self.NLAYER)],
-            ['VS%d' % i for i in range(self.NLAYER)],
-            ['PR%d' % i for i in range(self.NLAYER)],
-            ['RH%d' % i for i in range(self.NLAYER)]))
+        # positions of each parameter type in the full parameter array
+        self._slice_z = slice(0, self.NLAYER - 1)
+        self._slice_vs = slice(self.NLAYER - 1, 2 * self.NLAYER - 1)
+        self._slice_pr = slice(2 * self.NLAYER - 1, 3 * self.NLAYER - 1)
+        self._slice_rh = slice(3 * self.NLAYER - 1, 4 * self.NLAYER - 1)
+        self.KEYS = layer_keys(self.NLAYER, ["-Z", "VS", "PR", "RH"])
         self.DELTAM = np.hstack((
             [self.dz for _ in range(1, self.NLAYER)],
             [self.dvs for _ in range(self.NLAYER)],
             [self.dpr for _ in range(self.NLAYER)],
             [self.drh for _ in range(self.NLAYER)]))
 
-        self.IDXNOTLOCK = ascii_file.data['VINF'] < ascii_file.data['VSUP']  # index of dimension used, other parameters are kept constant
+        self.IDXNOTLOCK = VINF < VSUP  # index of dimension used, other parameters are kept constant
 
-        self.MDEFAULT = 0.5 * (ascii_file.data['VINF'] + ascii_file.data['VSUP'])  # used for dimensions that are not part of the model
+        self.MDEFAULT = 0.5 * (VINF + VSUP)  # used for dimensions that are not part of the model
+        # see self._fill, room is left at the end for VP (self._slice_vpout) so that inv allocates only one array
+        self._ZMDEFAULT = np.concatenate(([0.], self.MDEFAULT, np.zeros(self.NLAYER)))
+        self._slice_vpout = slice(4 * self.NLAYER - 1, 5 * self.NLAYER - 1)
+        self._INOTLOCK = np.flatnonzero(self.IDXNOTLOCK)  # same as IDXNOTLOCK, faster to gather
+        self._all_free = bool(self.IDXNOTLOCK.all())  # no locked parameter, see self._fill and self.__call__
         self.MMEAN = self.MDEFAULT[self.IDXNOTLOCK]
-        self.MINF = ascii_file.data['VINF'][self.IDXNOTLOCK]
-        self.MSUP = ascii_file.data['VSUP'][self.IDXNOTLOCK]
-        self.MSTD = 0.5 * (ascii_file.data['VSUP'] - ascii_file.data['VINF'])[self.IDXNOTLOCK]
+        self.MINF = VINF[self.IDXNOTLOCK]
+        self.MSUP = VSUP[self.IDXNOTLOCK]
+        self.MSTD = 0.5 * (VSUP - VINF)[self.IDXNOTLOCK]
 
     def boundaries(self):
         """see Parameterizer"""
-        Ztopsup, VPlow, VSlow, RHlow = self.inv(self.MINF)
-        Ztopinf, VPhgh, VShgh, RHhgh = self.inv(self.MSUP)
-        z = np.sort(np.unique(np.concatenate((Ztopinf, Ztopsup))))
+        (Ztopsup, Ztopinf), (VPlow, VPhgh), (VSlow, VShgh), (RHlow, RHhgh) = \
+            self._inv_batch(np.vstack((self.MINF, self.MSUP)))
+        z = np.union1d(Ztopinf, Ztopsup)
         PRlow = VPlow / VSlow  # because it is the way it has been defined in self.inv
         PRhgh = VPhgh / VShgh
         del VPlow, VPhgh
 
-        def f(Zinf, Zsup, V, which):
-            v1 = depthmodel1D(Zinf, V).interp(z, interpmethod="stairs")
-            v2 = depthmodel1D(Zsup, V).interp(z, interpmethod="stairs")
-            return depthmodel1D(z, which(np.concatenate(([v1], [v2]), axis=0), axis=0))
+        # layer number of each depth z in both models, the same for all fields
+        iinf = stairs_index(Ztopinf, z)
+        isup = stairs_index(Ztopsup, z)
+
+        def f(V, which):
+            v1 = V[iinf]
+            v2 = V[isup]
+            return depthmodel1D(z, which(v1, v2))
 
-        prlow = f(Ztopinf, Ztopsup, PRlow, np.min)
-        prhgh = f(Ztopinf, Ztopsup, PRhgh, np.max)
+        prlow = f(PRlow, np.minimum)
+        prhgh = f(PRhgh, np.maximum)
 
-        vslow = f(Ztopinf, Ztopsup, VSlow, np.min)
-        vshgh = f(Ztopinf, Ztopsup, VShgh, np.max)
+        vslow = f(VSlow, np.minimum)
+        vshgh = f(VShgh, np.maximum)
 
-        rhlow = f(Ztopinf, Ztopsup, RHlow, np.min)
-        rhhgh = f(Ztopinf, Ztopsup, RHhgh, np.max)
+        rhlow = f(RHlow, np.minimum)
+        rhhgh = f(RHhgh, np.maximum)
 
         vplow = depthmodel1D(z, prlow.values * vslow.values)
         vphgh = depthmodel1D(z, prhgh.values * vshgh.values)
@@ -253,49 +359,63 @@ class Parameterizer_mZVSPRRH(Parameterizer):
 
     def __call__(self, ZTOP, VP, VS, RH):
         """see Parameterizer"""
-        m = np.concatenate((-1.0 * ZTOP[1:], VS, VP / VS, RH))[self.IDXNOTLOCK]
+        M = np.empty_like(self.MDEFAULT)
+        np.negative(ZTOP[1:], out=M[self._slice_z])
+        M[self._slice_vs] = VS
+        np.divide(VP, VS, out=M[self._slice_pr])
+        M[self._slice_rh] = RH
+        m = M if self._all_free else M.take(self._INOTLOCK)
         return m
 
     def inv(self, m):
         """see Parameterizer"""
-        M = self.MDEFAULT.copy()
-        M[self.IDXNOTLOCK] = m  # overwrites default values with the one provided in m
-
-        nlayer = self.NLAYER  # (len(M) + 1) / 4
-        ZTOP = np.concatenate(([0.], -1.0 * M[: 1 * nlayer - 1]))
-        VS = M[1 * nlayer - 1: 2 * nlayer - 1]
-        PR = M[2 * nlayer - 1: 3 * nlayer - 1]
-        RH = M[3 * nlayer - 1: 4 * nlayer - 1]
-        VP = PR * VS
+        ZTOP, M = self._fill(m)
+        VS = M[..., self._slice_vs]
+        PR = M[..., self._slice_pr]
+        RH = M[..., self._slice_rh]
+        VP = np.multiply(PR, VS, out=M[..., self._slice_vpout])
 
         return ZTOP, VP, VS, RH
 
+    def _inv_batch(self, ms):
+        """see Parameterizer, self.inv works along the last axis"""
+        return self.inv(ms)
+
 
 class Parameterizer_mZVSVPRH(Parameterizer):
     """see Parameterizer_mZVSPRRH for doc"""
+    __slots__ = ('_slice_vp', '_slice_rh')
+
     def __init__(self, ascii_file):
 
         Parameterizer.__init__(self, ascii_file=ascii_file)
+        # VINF <= VSUP already checked by check_parameter_file
+        # read the columns once, as contiguous float arrays (the arrays derived from them will be too)
+        VINF = np.ascontiguousarray(ascii_file.data['VINF'], dtype=np.float64)
+        VSUP = np.ascontiguousarray(ascii_file.data['VSUP'], dtype=np.float64)
 
         assert ascii_file.metadata['TYPE'] == "mZVSVPRH"
-        assert np.all(ascii_file.data['VINF'] <= ascii_file.data['VSUP'])
-        if np.all(ascii_file.data['VINF'] == ascii_file.data['VSUP']):
+        if np.all(VINF == VSUP):
             print("Warning : all parameters are locked")
 
         self.NLAYER = ascii_file.metadata['NLAYER']
-        self.IDXNOTLOCK = ascii_file.data['VINF'] < ascii_file.data['VSUP']
-
-        self.MDEFAULT = 0.5 * (ascii_file.data['VINF'] + ascii_file.data['VSUP'])
-        self.KEYS = np.hstack(
-            (["-Z%d" % i for i in range(1, self.NLAYER)],
-             ['VS%d' % i for i in range(self.NLAYER)],
-             ['VP%d' % i for i in range(self.NLAYER)],
-             ['RH%d' % i for i in range(self.NLAYER)]))
+        # positions of each parameter type in the full parameter array
+        self._slice_z = slice(0, self.NLAYER - 1)
+        self._slice_vs = slice(self.NLAYER - 1, 2 * self.NLAYER - 1)
+        self._slice_vp = slice(2 * self.NLAYER - 1, 3 * self.NLAYER - 1)
+        self._slice_rh = slice(3 * self.NLAYER - 1, 4 * self.NLAYER - 1)
+        self.IDXNOTLOCK = VINF < VSUP
+
+        self.MDEFAULT = 0.5 * (VINF + VSUP)
+        self._ZMDEFAULT = np.concatenate(([0.], self.MDEFAULT))  # see self._fill
+        self._INOTLOCK = np.flatnonzero(self.IDXNOTLOCK)  # same as IDXNOTLOCK, faster to gather
+        self._all_free = bool(self.IDXNOTLOCK.all())  # no locked parameter, see self._fill and self.__call__
+        self.KEYS = layer_keys(self.NLAYER, ["-Z", "VS", "VP", "RH"])
 
         self.MMEAN = self.MDEFAULT[self.IDXNOTLOCK]
-        self.MINF = ascii_file.data['VINF'][self.IDXNOTLOCK]
-        self.MSUP = ascii_file.data['VSUP'][self.IDXNOTLOCK]
-        self.MSTD = 0.5 * (ascii_file.data['VSUP'] - ascii_file.data['VINF'])[self.IDXNOTLOCK]
+        self.MINF = VINF[self.IDXNOTLOCK]
+        self.MSUP = VSUP[self.IDXNOTLOCK]
+        self.MSTD = 0.5 * (VSUP - VINF)[self.IDXNOTLOCK]
         self.DELTAM = np.hstack((
             [self.dz for _ in range(1, self.NLAYER)],
             [self.dvs for _ in range(self.NLAYER)],
@@ -304,23 +424,27 @@ class Parameterizer_mZVSVPRH(Parameterizer):
 
     def boundaries(self):
         """see Parameterizer"""
-        Ztopsup, VPlow, VSlow, RHlow = self.inv(self.MINF)
-        Ztopinf, VPhgh, VShgh, RHhgh = self.inv(self.MSUP)
-        z = np.sort(np.unique(np.concatenate((Ztopinf, Ztopsup))))
+        (Ztopsup, Ztopinf), (VPlow, VPhgh), (VSlow, VShgh), (RHlow, RHhgh) = \
+            self._inv_batch(np.vstack((self.MINF, self.MSUP)))
+        z = np.union1d(Ztopinf, Ztopsup)
+
+        # layer number of each depth z in both models, the same for all fields
+        iinf = stairs_index(Ztopinf, z)
+        isup = stairs_index(Ztopsup, z)
 
-        def f(Zinf, Zsup, V, which):
-            v1 = depthmodel1D(Zinf, V).interp(z, interpmethod="stairs")
-            v2 = depthmodel1D(Zsup, V).interp(z, interpmethod="stairs")
-            return depthmodel1D(z, which(np.concatenate(([v1], [v2]), axis = 0), axis = 0))
+        def f(V, which):
+            v1 = V[iinf]
+            v2 = V[isup]
+            return depthmodel1D(z, which(v1, v2))
 
-        vplow = f(Ztopinf, Ztopsup, VPlow, np.min)
-        vphgh = f(Ztopinf, Ztopsup, VPhgh, np.max)
+        vplow = f(VPlow, np.minimum)
+        vphgh = f(VPhgh, np.maximum)
 
-        vslow = f(Ztopinf, Ztopsup, VSlow, np.min)
-        vshgh = f(Ztopinf, Ztopsup, VShgh, np.max)
+        vslow = f(VSlow, np.minimum)
+        vshgh = f(VShgh, np.maximum)
 
-        rhlow = f(Ztopinf, Ztopsup, RHlow, np.min)
-        rhhgh = f(Ztopinf, Ztopsup, RHhgh, np.max)
+        rhlow = f(RHlow, np.minimum)
+        rhhgh = f(RHhgh, np.maximum)
 
         prlow = depthmodel1D(z, vphgh.values / vslow.values)
         prhgh = depthmodel1D(z, vplow.values / vshgh.values)
@@ -329,49 +453,62 @@ class Parameterizer_mZVSVPRH(Parameterizer):
 
     def __call__(self, ZTOP, VP, VS, RH):
         """see Parameterizer"""
-        m = np.concatenate((-1.0 * ZTOP[1:], VS, VP, RH))[self.IDXNOTLOCK]
+        M = np.empty_like(self.MDEFAULT)
+        np.negative(ZTOP[1:], out=M[self._slice_z])
+        M[self._slice_vs] = VS
+        M[self._slice_vp] = VP
+        M[self._slice_rh] = RH
+        m = M if self._all_free else M.take(self._INOTLOCK)
         return m
 
     def inv(self, m):
         """see Parameterizer"""
-        M = self.MDEFAULT.copy()
-        M[self.IDXNOTLOCK] = m  # overwrites default values with the one provided in m
-
-        nlayer = self.NLAYER  # (len(M) + 1) / 4
-        ZTOP = np.concatenate(([0.], -1.0 * M[: 1 * nlayer - 1]))
-        VS = M[1 * nlayer - 1: 2 * nlayer - 1]
-        VP = M[2 * nlayer - 1: 3 * nlayer - 1]
-        RH = M[3 * nlayer - 1: 4 * nlayer - 1]
+        ZTOP, M = self._fill(m)
+        VS = M[..., self._slice_vs]
+        VP = M[..., self._slice_vp]
+        RH = M[..., self._slice_rh]
 
         return ZTOP, VP, VS, RH
 
+    def _inv_batch(self, ms):
+        """see Parameterizer, self.inv works along the last axis"""
+        return self.inv(ms)
+
 
 class Parameterizer_mZVSPRzRHvp(Parameterizer):
     """see Parameterizer_mZVSPRRH for doc"""
+    __slots__ = ('PRzName', 'RHvpName', 'PRz', 'RHvp')
 
     def __init__(self, ascii_file):
         """see Parameterizer"""
         Parameterizer.__init__(self, ascii_file=ascii_file)
+        # VINF <= VSUP already checked by check_parameter_file
+        # read the columns once, as contiguous float arrays (the arrays derived from them will be too)
+        VINF = np.ascontiguousarray(ascii_file.data['VINF'], dtype=np.float64)
+        VSUP = np.ascontiguousarray(ascii_file.data['VSUP'], dtype=np.float64)
         assert ascii_file.metadata['TYPE'] == "mZVSPRzRHvp"
-        assert np.all(ascii_file.data['VINF'] <= ascii_file.data['VSUP'])
-        if np.all(ascii_file.data['VINF'] == ascii_file.data['VSUP']):
+        if np.all(VINF == VSUP):
             print ("Warning : all parameters are locked")
 
         self.NLAYER = ascii_file.metadata['NLAYER']
-        self.KEYS = np.hstack(
-            (["-Z%d" % i for i in range(1, self.NLAYER)],
-             ['VS%d' % i for i in range(self.NLAYER)]))
+        # positions of each parameter type in the full parameter array
+        self._slice_z = slice(0, self.NLAYER - 1)
+        self._slice_vs = slice(self.NLAYER - 1, 2 * self.NLAYER - 1)
+        self.KEYS = layer_keys(self.NLAYER, ["-Z", "VS"])
         self.DELTAM = np.hstack((
             [self.dz for _ in range(1, self.NLAYER)],
             [self.dvs for _ in range(self.NLAYER)]))
 
-        self.IDXNOTLOCK = ascii_file.data['VINF'] < ascii_file.data['VSUP']
+        self.IDXNOTLOCK = VINF < VSUP
 
-        self.MDEFAULT = 0.5 * (ascii_file.data['VINF'] + ascii_file.data['VSUP'])
+        self.MDEFAULT = 0.5 * (VINF + VSUP)
+        self._ZMDEFAULT = np.concatenate(([0.], self.MDEFAULT))  # see self._fill
+        self._INOTLOCK = np.flatnonzero(self.IDXNOTLOCK)  # same as IDXNOTLOCK, faster to gather
+        self._all_free = bool(self.IDXNOTLOCK.all())  # no locked parameter, see self._fill and self.__call__
         self.MMEAN = self.MDEFAULT[self.IDXNOTLOCK]
-        self.MINF = ascii_file.data['VINF'][self.IDXNOTLOCK]
-        self.MSUP = ascii_file.data['VSUP'][self.IDXNOTLOCK]
-        self.MSTD = 0.5 * (ascii_file.data['VSUP'] - ascii_file.data['VINF'])[self.IDXNOTLOCK]
+        self.MINF = VINF[self.IDXNOTLOCK]
+        self.MSUP = VSUP[self.IDXNOTLOCK]
+        self.MSTD = 0.5 * (VSUP - VINF)[self.IDXNOTLOCK]
 
         self.PRzName = 'VP/VS=f(Z)'
         self.RHvpName = 'RH=f(VP)'
@@ -385,53 +522,64 @@ class Parameterizer_mZVSPRzRHvp(Parameterizer):
 
     def __call__(self, ZTOP, VP, VS, RH):
         """see Parameterizer"""
-        m = np.concatenate((-1.0 * ZTOP[1:], VS))[self.IDXNOTLOCK]
+        M = np.empty_like(self.MDEFAULT)
+        np.negative(ZTOP[1:], out=M[self._slice_z])
+        M[self._slice_vs] = VS
+        m = M if self._all_free else M.take(self._INOTLOCK)
         return m
 
     def inv(self, m):
         """see Parameterizer"""
-        M = self.MDEFAULT.copy()
-        M[self.IDXNOTLOCK] = m  # overwrites default values with the one provided in m
-
-        nlayer = self.NLAYER  # (len(M) + 1) / 4
-        ZTOP = np.concatenate(([0.], -1.0 * M[: 1 * nlayer - 1]))
-        VS = M[1 * nlayer - 1: 2 * nlayer - 1]
+        ZTOP, M = self._fill(m)
+        VS = M[self._slice_vs]
 
         # infer VP and RH from VS and input laws
-        ZMID = np.concatenate((0.5 * (ZTOP[1:] + ZTOP[:-1]), [1.5 * ZTOP[-1]]))
-        VP = VS * self.PRz(Z=ZMID)
-        RH = self.RHvp(VP)
+        # (the laws are compiled once by Relation, call the functions directly)
+        ZMID = np.empty_like(ZTOP)  # middle of each layer, 1.5 times the top depth for the half space
+        np.add(ZTOP[1:], ZTOP[:-1], out=ZMID[:-1])
+        ZMID[:-1] *= 0.5
+        ZMID[-1] = 1.5 * ZTOP[-1]
+        VP = VS * self.PRz.fun(Z=ZMID)
+        RH = self.RHvp.fun(VP)
 
         return ZTOP, VP, VS, RH
 
 
 class Parameterizer_mZVSPRzRHz(Parameterizer):
     """see Parameterizer_mZVSPRRH for doc"""
+    __slots__ = ('PRzName', 'RHzName', 'PRz', 'RHz')
 
     def __init__(self, ascii_file):
         """see Parameterizer"""
 
         Parameterizer.__init__(self, ascii_file=ascii_file)
+        # VINF <= VSUP already checked by check_parameter_file
+        # read the columns once, as contiguous float arrays (the arrays derived from them will be too)
+        VINF = np.ascontiguousarray(ascii_file.data['VINF'], dtype=np.float64)
+        VSUP = np.ascontiguousarray(ascii_file.data['VSUP'], dtype=np.float64)
 
         assert ascii_file.metadata['TYPE'] == "mZVSPRzRHz"
-        assert np.all(ascii_file.data['VINF'] <= ascii_file.data['VSUP'])
-        if np.all(ascii_file.data['VINF'] == ascii_file.data['VSUP']):
+        if np.all(VINF == VSUP):
             print ("Warning : all parameters are locked")
 
         self.NLAYER = ascii_file.metadata['NLAYER']
-        self.KEYS = np.hstack(
-            (["-Z%d" % i for i in range(1, self.NLAYER)],
-             ['VS%d' % i for i in range(self.NLAYER)]))
+        # positions of each parameter type in the full parameter array
+        self._slice_z = slice(0, self.NLAYER - 1)
+        self._slice_vs = slice(self.NLAYER - 1, 2 * self.NLAYER - 1)
+        self.KEYS = layer_keys(self.NLAYER, ["-Z", "VS"])
         self.DELTAM = np.hstack((
             [self.dz for _ in range(1, self.NLAYER)],
             [self.dvs for _ in range(self.NLAYER)]))
-        self.IDXNOTLOCK = ascii_file.data['VINF'] < ascii_file.data['VSUP']
+        self.IDXNOTLOCK = VINF < VSUP
 
-        self.MDEFAULT = 0.5 * (ascii_file.data['VINF'] + ascii_file.data['VSUP'])
+        self.MDEFAULT = 0.5 * (VINF + VSUP)
+        self._ZMDEFAULT = np.concatenate(([0.], self.MDEFAULT))  # see self._fill
+        self._INOTLOCK = np.flatnonzero(self.IDXNOTLOCK)  # same as IDXNOTLOCK, faster to gather
+        self._all_free = bool(self.IDXNOTLOCK.all())  # no locked parameter, see self._fill and self.__call__
         self.MMEAN = self.MDEFAULT[self.IDXNOTLOCK]
-        self.MINF = ascii_file.data['VINF'][self.IDXNOTLOCK]
-        self.MSUP = ascii_file.data['VSUP'][self.IDXNOTLOCK]
-        self.MSTD = 0.5 * (ascii_file.data['VSUP'] - ascii_file.data['VINF'])[self.IDXNOTLOCK]
+        self.MINF = VINF[self.IDXNOTLOCK]
+        self.MSUP = VSUP[self.IDXNOTLOCK]
+        self.MSTD = 0.5 * (VSUP - VINF)[self.IDXNOTLOCK]
 
         self.PRzName = 'VP/VS=f(Z)'
         self.RHzName = 'RH=f(Z)'
@@ -444,51 +592,62 @@ class Parameterizer_mZVSPRzRHz(Parameterizer):
 
     def __call__(self, ZTOP, VP, VS, RH):
         """VP and RH are ignored since they are not parameters of the model"""
-        m = np.concatenate((-1.0 * ZTOP[1:], VS))[self.IDXNOTLOCK]
+        M = np.empty_like(self.MDEFAULT)
+        np.negative(ZTOP[1:], out=M[self._slice_z])
+        M[self._slice_vs] = VS
+        m = M if self._all_free else M.take(self._INOTLOCK)
         return m
 
     def inv(self, m):
         """see Parameterizer"""
-        M = self.MDEFAULT.copy()
-        M[self.IDXNOTLOCK] = m  # overwrites default values with the one provided in m
-
-        nlayer = self.NLAYER  # (len(M) + 1) / 4
-        ZTOP = np.concatenate(([0.], -1.0 * M[: 1 * nlayer - 1]))
-        VS = M[1 * nlayer - 1: 2 * nlayer - 1]
+        ZTOP, M = self._fill(m)
+        VS = M[self._slice_vs]
 
         # infer VP and RH from VS and input laws
-        ZMID = np.concatenate((0.5 * (ZTOP[1:] + ZTOP[:-1]), [1.5 * ZTOP[-1]]))
-        VP = VS * self.PRz(Z=ZMID)
-        RH = self.RHz(Z=ZMID)
+        # (the laws are compiled once by Relation, call the functions directly)
+        ZMID = np.empty_like(ZTOP)  # middle of each layer, 1.5 times the top depth for the half space
+        np.add(ZTOP[1:], ZTOP[:-1], out=ZMID[:-1])
+        ZMID[:-1] *= 0.5
+        ZMID[-1] = 1.5 * ZTOP[-1]
+        VP = VS * self.PRz.fun(Z=ZMID)
+        RH = self.RHz.fun(Z=ZMID)
 
         return ZTOP, VP, VS, RH
 
 
 class Parameterizer_mZVSVPvsRHvp(Parameterizer):
     """see Parameterizer_mZVSPRRH for doc"""
+    __slots__ = ('VPvsName', 'RHvpName', 'VPvs', 'RHvp')
 
     def __init__(self, ascii_file):
         """see Parameterizer"""
         Parameterizer.__init__(self, ascii_file=ascii_file)
+        # VINF <= VSUP already checked by check_parameter_file
+        # read the columns once, as contiguous float arrays (the arrays derived from them will be too)
+        VINF = np.ascontiguousarray(ascii_file.data['VINF'], dtype=np.float64)
+        VSUP = np.ascontiguousarray(ascii_file.data['VSUP'], dtype=np.float64)
         assert ascii_file.metadata['TYPE'] == "mZVSVPvsRHvp"
-        assert np.all(ascii_file.data['VINF'] <= ascii_file.data['VSUP'])
-        if np.all(ascii_file.data['VINF'] == ascii_file.data['VSUP']):
+        if np.all(VINF == VSUP):
             print ("Warning : all parameters are locked")
 
         self.NLAYER = ascii_file.metadata['NLAYER']
-        self.IDXNOTLOCK = ascii_file.data['VINF'] < ascii_file.data['VSUP']
-        self.KEYS = np.hstack(
-            (["-Z%d" % i for i in range(1, self.NLAYER)],
-             ['VS%d' % i for i in range(self.NLAYER)]))
+        # positions of each parameter type in the full parameter array
+        self._slice_z = slice(0, self.NLAYER - 1)
+        self._slice_vs = slice(self.NLAYER - 1, 2 * self.NLAYER - 1)
+        self.IDXNOTLOCK = VINF < VSUP
+        self.KEYS = layer_keys(self.NLAYER, ["-Z", "VS"])
         self.DELTAM = np.hstack((
             [self.dz for _ in range(1, self.NLAYER)],
             [self.dvs for _ in range(self.NLAYER)]))
 
-        self.MDEFAULT = 0.5 * (ascii_file.data['VINF'] + ascii_file.data['VSUP'])
+        self.MDEFAULT = 0.5 * (VINF + VSUP)
+        self._ZMDEFAULT = np.concatenate(([0.], self.MDEFAULT))  # see self._fill
+        self._INOTLOCK = np.flatnonzero(self.IDXNOTLOCK)  # same as IDXNOTLOCK, faster to gather
+        self._all_free = bool(self.IDXNOTLOCK.all())  # no locked parameter, see self._fill and self.__call__
         self.MMEAN = self.MDEFAULT[self.IDXNOTLOCK]
-        self.MINF = ascii_file.data['VINF'][self.IDXNOTLOCK]
-        self.MSUP = ascii_file.data['VSUP'][self.IDXNOTLOCK]
-        self.MSTD = 0.5 * (ascii_file.data['VSUP'] - ascii_file.data['VINF'])[self.IDXNOTLOCK]
+        self.MINF = VINF[self.IDXNOTLOCK]
+        self.MSUP = VSUP[self.IDXNOTLOCK]
+        self.MSTD = 0.5 * (VSUP - VINF)[self.IDXNOTLOCK]
 
         self.VPvsName = 'VP=f(VS)'
         self.RHvpName = 'RH=f(VP)'
@@ -517,17 +676,21 @@ class Parameterizer_mZVSVPvsRHvp(Parameterizer):
     def boundaries(self):
 
         # default behavior, to be customized if needed
-        Ztopsup, VPlow, VSlow, RHlow = self.inv(self.MINF)
-        Ztopinf, VPhgh, VShgh, RHhgh = self.inv(self.MSUP)
-        z = np.sort(np.unique(np.concatenate((Ztopinf, Ztopsup))))
+        (Ztopsup, Ztopinf), (VPlow, VPhgh), (VSlow, VShgh), (RHlow, RHhgh) = \
+            self._inv_batch(np.vstack((self.MINF, self.MSUP)))
+        z = np.union1d(Ztopinf, Ztopsup)
 
-        def f(Zinf, Zsup, V, which):
-            v1 = depthmodel1D(Zinf, V).interp(z, interpmethod="stairs")
-            v2 = depthmodel1D(Zsup, V).interp(z, interpmethod="stairs")
-            return depthmodel1D(z, which(np.concatenate(([v1], [v2]), axis=0), axis=0))
+        # layer number of each depth z in both models, the same for all fields
+        iinf = stairs_index(Ztopinf, z)
+        isup = stairs_index(Ztopsup, z)
 
-        vslow = f(Ztopinf, Ztopsup, VSlow, np.min)
-        vshgh = f(Ztopinf, Ztopsup, VShgh, np.max)
+        def f(V, which):
+            v1 = V[iinf]
+            v2 = V[isup]
+            return depthmodel1D(z, which(v1, v2))
+
+        vslow = f(VSlow, np.minimum)
+        vshgh = f(VShgh, np.maximum)
 
         vplow = depthmodel1D(z, self.VPvs(VS=vslow.values))
         vphgh = depthmodel1D(z, self.VPvs(VS=vshgh.values))
@@ -542,20 +705,20 @@ class Parameterizer_mZVSVPvsRHvp(Parameterizer):
 
     def __call__(self, ZTOP, VP, VS, RH):
         """VP and RH are ignored since they are not parameters of the model"""
-        m = np.concatenate((-1.0 * ZTOP[1:], VS))[self.IDXNOTLOCK]
+        M = np.empty_like(self.MDEFAULT)
+        np.negative(ZTOP[1:], out=M[self._slice_z])
+        M[self._slice_vs] = VS
+        m = M if self._all_free else M.take(self._INOTLOCK)
         return m
 
     def inv(self, m):
         """see Parameterizer"""
-        M = self.MDEFAULT.copy()
-        M[self.IDXNOTLOCK] = m  # overwrites default values with the one provided in m
-
-        nlayer = self.NLAYER  # (len(M) + 1) / 4
-        ZTOP = np.concatenate(([0.], -1.0 * M[: 1 * nlayer - 1]))
-        VS = M[1 * nlayer - 1: 2 * nlayer - 1]
+        ZTOP, M = self._fill(m)
+        VS = M[self._slice_vs]
 
         # infer VP and RH from VS and input laws
-        VP = self.VPvs(VS=VS)
-        RH = self.RHvp(VP=VP)
+        # (the laws are compiled once by Relation, call the functions directly)
+        VP = self.VPvs.fun(VS=VS)
+        RH = self.RHvp.fun(VP=VP)
 
         return ZTOP, VP, VS, RH
@@ -1,5 +1,7 @@
 import os, glob
 import warnings
+from itertools import groupby
+from operator import itemgetter
 import numpy as np
 from srfpython.depthdisp.depthdispdisplay import plt, showme
 from srfpython.HerrMet.runfile import RunFile
@@ -80,35 +82,35 @@ def manage(argv, verbose, mapkwargs):
             rundb.summary(head=rootname + " : ")
 
     showfun = showme
-    if "-inline" in argv.keys():
+    if "-inline" in argv:
         showfun = plt.show
 
     # more options
-    if np.any([opt in argv.keys() for opt in ["-stats", "-delbad", "-delchains", "-plot"]]):
+    if {"-stats", "-delbad", "-delchains", "-plot"}.intersection(argv):
         fig = None
-        if "-plot" in argv.keys():
+        if "-plot" in argv:
             fig = plt.figure(figsize=(8, 4))
 
         for rootname, runfile in zip(rootnames, runfiles):
 
             with RunFile(runfile, verbose=verbose) as rundb:
                 # ------------ print chains stats
-                if "-stats" in argv.keys():
+                if "-stats" in argv:
                     rundb.stats(head=rootname + " : ")
 
                 # ------------ rm
-                if "-delbad" in argv.keys():
+                if "-delbad" in argv:
                     rundb.del_bad(llkmin=argv['-delbad'][0])
 
-                if "-delchains" in argv.keys():
+                if "-delchains" in argv:
                     rundb.del_chain(chainid=argv['-delchains'])
 
                 # ------------ plot
-                if "-plot" in argv.keys():
+                if "-plot" in argv:
                     vmin = argv['-plot'][0] if len(argv['-plot']) else None
                     s = rundb.select('''
-                    select CHAINID, group_concat(NITER), group_concat(LLK) from MODELS
-                        group by CHAINID 
+                    select CHAINID, NITER, LLK from MODELS
+                        order by CHAINID, NITER
                         ''')
                     if s is None:
                         warnings.warn('no chains found, if the inversion is running, '
@@ -119,14 +121,15 @@ def manage(argv, verbose, mapkwargs):
                     ax0 = fig.add_subplot(121)
                     ax1 = fig.add_subplot(122, sharey=ax0)
                     LLKs = []
-                    for CHAINID, NITER, LLK in s:
-                        NITER = np.asarray(NITER.split(','), int)
-                        LLK = np.asarray(LLK.split(','), float)
+                    for CHAINID, rows in groupby(s, key=itemgetter(0)):
+                        rows = list(rows)
+                        NITER = np.fromiter((row[1] for row in rows), int, count=len(rows))
+                        LLK = np.fromiter((row[2] for row in rows), float, count=len(rows))
                         ax0.plot(NITER, LLK)
                         ax0.text(NITER[-1], LLK[-1], CHAINID).set_clip_on(True)
-                        LLKs = np.concatenate((LLKs, LLK))
+                        LLKs.append(LLK)
 
-                    ax1.plot(np.sort(LLKs)[::-1])
+                    ax1.plot(np.sort(np.concatenate(LLKs))[::-1])
                     if vmin is not None:
                         ax0.set_ylim(vmin, 0)
                     ax0.set_xlabel('# iteration')
@@ -141,5 +144,5 @@ def manage(argv, verbose, mapkwargs):
                         print('saving ' + statsfile)
                     fig.savefig(statsfile)
 
-        if "-plot" in argv.keys():
+        if "-plot" in argv:
             plt.close(fig)
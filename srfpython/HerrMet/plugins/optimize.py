@@ -5,23 +5,22 @@ import warnings
 import numpy as np
 import scipy.sparse as sp
 from scipy.sparse import linalg as splinalg
-from srfpython.depthdisp.depthmodels import depthmodel_from_mod96
+from srfpython.depthdisp.depthmodels import depthmodel_from_mod96, stairs_interp
 from srfpython.standalone.multipro8 import Job, MapSync
 from srfpython.depthdisp.dispcurves import surf96reader
-from srfpython.standalone.stdout import waitbarpipe
-from srfpython.HerrMet.datacoders import Datacoder_log, makedatacoder
+from srfpython.HerrMet.datacoders import Datacoder_log, makedatacoders_from_arrays
 from srfpython.HerrMet.optimizetools import ForwardOperator, ModelSmoother, ModelCovarianceMatrix
 from srfpython.utils import Timer
 from srfpython.HerrMet.files import \
     HERRMETOPTIMIZEPARAMFILE, HERRMETOPTIMIZEPRIORFILE, \
-    HERRMETOPTIMIZEDOBSFILE, HERRMETOPTIMIZEINVFILE
+    HERRMETOPTIMIZEDOBSFILE, HERRMETOPTIMIZEINVFILE, HERRMETOPTIMIZETHEORYSFILE
 
 # ------------------------------ defaults
 default_option = None
 
 # ------------------------------ autorized_keys
 authorized_keys = ["-h", "-help",
-                   "-temp", "-mprior", "-dobs", "-inv", "-show"]
+                   "-temp", "-mprior", "-dobs", "-inv", "-nocache", "-show"]
 
 # ------------------------------ help messages
 short_help = "--optimize   3D optimization plugin"
@@ -35,11 +34,15 @@ long_help = """\
                      created and customized after option -temp
     -dobs            collect the observed dispersion points to fit
     -inv             run the linearized inversion
+                     the theory operators are saved to {theorysfile}
+                     and reused by the next runs as long as the inputs do not change
+    -nocache         with -inv, do not read nor write {theorysfile}
     -show  s f       show a slice accross the prior (from point wise depth inv), 
                      starting and final models
                      provide the slice direction z y or x and the slice value in km
     -h, -help        display the help message for this plugin 
-""".format(default_option=default_option)
+""".format(default_option=default_option,
+           theorysfile=HERRMETOPTIMIZETHEORYSFILE)
 
 # ------------------------------ example usage
 example = """\
@@ -110,16 +113,36 @@ def load_optimize_parameters():
     return nx, ny, newnz, dx, dy, newdz, ndecim, Lh, Lv, vsunc, damping, extractfiles, datafiles
 
 
-def add_to_npz(npzfile, allow_pickle=False, **kwargs):
+def parameterizer_strings_from_bounds(parameterizer_header, vs_bounds):
+    """
+    rebuild the parameterizer string of each node
+    :param parameterizer_header: the part of the parameterizer string common to all the nodes
+    :param vs_bounds: array, VINF and VSUP of the VS parameters, config = node, layer, (vinf, vsup)
+    :return parameterizer_strings: list of strings, one per node
+    """
+    nnode, nlayer, _ = vs_bounds.shape
+    template = parameterizer_header + \
+        "".join(["VS{} {{}} {{}}\n".format(i) for i in range(nlayer)])
+    return [template.format(*bounds) for bounds in vs_bounds.reshape((nnode, 2 * nlayer))]
+
+
+def add_to_npz(npzfile, allow_pickle=False, contents=None, **kwargs):
     """
     add onei or more field(s) to an existing npzfile (implies loading the existing fields)
     :param npzfile: name of the file to load and write
-    :param kwargs: fields to add or update
+    :param contents: dict, the fields of npzfile as returned by the previous call,
+        avoids loading the file again, None means load the existing fields from npzfile
+    :param kwargs: fields to add or update, they are not copied, do not modify them in place afterwards
+    :return d: dict, all the fields written to npzfile, to be passed as contents in the next call
     """
-    if os.path.isfile(npzfile):
+    if contents is not None:
+        # the caller knows the content of the file
+        d = dict(contents, **kwargs)
+
+    elif os.path.isfile(npzfile):
 
-        # load if not in kwargs
         keys = kwargs.keys()
+        # load if not in kwargs
         with np.load(npzfile) as loader:
             loaded = {f: loader[f] for f in loader.files if f not in keys}
 
@@ -132,6 +155,7 @@ def add_to_npz(npzfile, allow_pickle=False, **kwargs):
     # save
     from numpy.lib.npyio import _savez
     _savez(npzfile, args=(), kwds=d, compress=True, allow_pickle=allow_pickle)
+    return d
 
 
 def optimize(argv, verbose, mapkwargs):
@@ -188,9 +212,7 @@ def optimize(argv, verbose, mapkwargs):
         # =============== load the results of the point wise inversion
         # config = z, y, x
         zmid = np.hstack((ztop[:-1] + 0.5 * (ztop[1:] - ztop[:-1]), ztop[-1] + ztop[1] - ztop[0]))
-        vs_cube = np.zeros((len(ztop), len(y), len(x)), float)
-        vsunc_cube = np.zeros_like(vs_cube)
-
+        ztops, vss = [], []
         for i, iy in enumerate(iys):
             for j, ix in enumerate(ixs):
                 try:
@@ -200,18 +222,37 @@ def optimize(argv, verbose, mapkwargs):
                 except Exception as e:
                     raise e
 
-                vs_cube[:, i, j] = dm.vs.interp(z=zmid)
-                vsunc_cube[:, i, j] = vsunc
+                # read the layered model directly, the stairs arrays are not needed here
+                ztops.append(dm.vs.z)
+                vss.append(dm.vs.values)
+
+        # each node has its own depth grid, pad them to the same number of layers
+        # (padding layers start at an infinite depth) to resample all the nodes at once
+        nnode, nlayer = len(ztops), max([len(_) for _ in ztops])
+        ztops_padded = np.full((nnode, nlayer), np.inf)
+        vss_padded = np.zeros((nnode, nlayer))
+        for n, (_ztop, _vs) in enumerate(zip(ztops, vss)):
+            ztops_padded[n, :len(_ztop)] = _ztop
+            vss_padded[n, :len(_vs)] = _vs
+
+        # read all the nodes at the mid depths, config = node, z
+        # the cubes are stored in single precision (km/s), -inv converts them back to double precision
+        vs_cube = stairs_interp(ztops_padded, vss_padded, zmid).T.reshape((nz, ny, nx)).astype(np.float32)
+
+        # the uncertainty is uniform, no need to fill it column by column
+        # nor to store it in memory, a read only view is enough until it is written to disk
+        vsunc_cube = np.broadcast_to(np.float32(vsunc), vs_cube.shape)
 
         # ===============
-        iz, jy, kx = np.mgrid[:nz, :ny, :nx]
-
-        ixsflat = ixs[kx].flat[:]
-        iysflat = iys[jy].flat[:]
-        xflat = x[kx].flat[:]
-        yflat = y[jy].flat[:]
-        ztopflat = ztop[iz].flat[:]
-        zmidflat = zmid[iz].flat[:]
+        # broadcast the 1D grids to the cube shape (views, no index cubes needed)
+        # config = z, y, x, the flat arrays are in C order
+        shape = (nz, ny, nx)
+        ixsflat = np.broadcast_to(ixs, shape).ravel()
+        iysflat = np.broadcast_to(iys[:, np.newaxis], shape).ravel()
+        xflat = np.broadcast_to(x, shape).ravel()
+        yflat = np.broadcast_to(y[:, np.newaxis], shape).ravel()
+        ztopflat = np.broadcast_to(ztop[:, np.newaxis, np.newaxis], shape).ravel()
+        zmidflat = np.broadcast_to(zmid[:, np.newaxis, np.newaxis], shape).ravel()
         Mprior = vs_cube  # .flat[:]
         Munc = vsunc_cube  # .flat[:]
 
@@ -235,42 +276,18 @@ def optimize(argv, verbose, mapkwargs):
         #fmt %s      %f            %f
         """.format(len(ztop)).replace('    #', '#')
 
-        for i in range(1, len(ztop)):
-            # force VINF=VSUP => means lock the depth of the interfaces in the theory operator
-            parameter_string_header += "-Z{} {} {}\n".format(i, -ztop[i], -ztop[i])  # add locked depth interfaces
+        # force VINF=VSUP => means lock the depth of the interfaces in the theory operator
+        parameter_string_header += "".join(
+            ["-Z{} {} {}\n".format(i, -ztop[i], -ztop[i])  # add locked depth interfaces
+             for i in range(1, len(ztop))])
 
-        def job_generator():
-            for iy in range(ny):
-                for jx in range(nx):  # order matters!!!!
-                    vs = Mprior[:, iy, jx]
-                    yield Job(iy, jx, ztop, vs)
-
-        def job_handler(iy, jx, ztop, vs):
-            parameterizer_string = parameter_string_header
-
-            for i in range(len(ztop)):
-                # SET VINF < VS extracted from pointwise inv < VSUP
-                # such as parameterizer.MMEAN corresponds to the extracted vs
-                parameterizer_string += "VS{} {} {}\n".format(i, vs[i] - 0.01, vs[i] + 0.01)
-            # parameterizer = load_paramfile(parameter_string, verbose=False)[0]
-            return iy, jx, parameterizer_string
-
-        wb = None
-        if verbose:
-            wb = waitbarpipe('parameterizers')
-
-        parameterizer_strings = []
-        with MapSync(job_handler, job_generator(), **mapkwargs) as ma:  # order matters!!!!
-            for jobid, (iy, jx, parameter_string), _, _ in ma:
-                parameterizer_strings.append(parameter_string)
-
-                if verbose:
-                    wb.refresh(jobid / float(nx * ny))
-
-        if verbose:
-            wb.close()
-
-        parameterizer_strings = np.asarray(parameterizer_strings, str)
+        # the nodes only differ by the VS lines, store the header once and the bounds of each node
+        # SET VINF < VS extracted from pointwise inv < VSUP
+        # such as parameterizer.MMEAN corresponds to the extracted vs
+        # config = node, layer, (vinf, vsup)
+        # use the stored values so that the parameterizers match the prior cube loaded by -inv
+        vs_nodes = Mprior.reshape((nz, ny * nx)).T.astype(float)  # order matters!!!!
+        vs_bounds = np.stack((vs_nodes - 0.01, vs_nodes + 0.01), axis=-1)
 
         np.savez(
             HERRMETOPTIMIZEPRIORFILE,
@@ -280,7 +297,7 @@ def optimize(argv, verbose, mapkwargs):
             ztop=ztop, zmid=zmid, zedges=zedges, ztopflat=ztopflat, zmidflat=zmidflat,
             Mprior=Mprior, Munc=Munc,
             damping=damping, Lv=Lv, Lh=Lh,
-            parameterizer_strings=parameterizer_strings)
+            parameterizer_header=parameter_string_header, vs_bounds=vs_bounds)
 
     # ===============================
     if "-dobs" in argv.keys():
@@ -297,56 +314,63 @@ def optimize(argv, verbose, mapkwargs):
         ixs = np.arange(nx)[::ndecim]  # indexs used to name the files
         iys = np.arange(ny)[::ndecim]
 
-        datacoder_strings = []
-        for i, iy in enumerate(iys):
-            for j, ix in enumerate(ixs):  # order matters!!!!
+        def job_generator():
+            for iy in iys:
+                for ix in ixs:  # order matters!!!!
+                    yield Job(iy, ix)
 
-                try:
-                    datafile = datafiles.format(iy=iy, ix=ix)
-                    if verbose:
-                        print('loading ', datafile)
-                    s96 = surf96reader(filename=datafile)
+        def job_handler(iy, ix):
+            datafile = datafiles.format(iy=iy, ix=ix)
+            if verbose:
+                print('loading ', datafile)
+            s96 = surf96reader(filename=datafile)
 
-                except Exception as e:
-                    raise e
+            # use the arrays directly, no need to go through a surf96 string
+            datacoder = Datacoder_log(*s96.wtmfvd())
+            return datacoder
 
-                datacoder_string = str(s96)
-                datacoder_strings.append(datacoder_string)
+        datacoders = []
+        with MapSync(job_handler, job_generator(), **mapkwargs) as ma:  # order matters!!!!
+            for _, datacoder, _, _ in ma:
+                datacoders.append(datacoder)
 
-        datacoder_strings = np.asarray(datacoder_strings, str)
-        datacoders = [makedatacoder(datacoder_string, which=Datacoder_log) for datacoder_string in
-                      datacoder_strings]
+        # the number of data per node is known once the files are read, write the targets in place
+        Nobs = np.array([len(datacoder.waves) for datacoder in datacoders])
+        data_offsets = np.hstack((0, np.cumsum(Nobs)))
+        Dobs = np.empty(data_offsets[-1], float)
+        Dunc = np.empty_like(Dobs)
 
-        Nobs = []
         Waves = []
         Types = []
         Modes = []
         Freqs = []
-        Dobs = []
-        Dunc = []
-        for datacoder in datacoders:
+        Values = []
+        Dvalues = []
+        for nnode, datacoder in enumerate(datacoders):
             _dobs, _CDinv = datacoder.target()
-            Nobs.append(len(datacoder.waves))
+            begin, end = data_offsets[nnode], data_offsets[nnode + 1]
+            Dobs[begin:end] = _dobs
+            Dunc[begin:end] = _CDinv ** -0.5
             Waves.append(datacoder.waves)
             Types.append(datacoder.types)
             Modes.append(datacoder.modes)
             Freqs.append(datacoder.freqs)
-            Dobs.append(_dobs)
-            Dunc.append(_CDinv ** -0.5)
+            Values.append(datacoder.values)
+            Dvalues.append(datacoder.dvalues)
 
-        Nobs = np.array(Nobs)
         Waves = np.hstack(Waves)
         Types = np.hstack(Types)
         Modes = np.hstack(Modes)
         Freqs = np.hstack(Freqs)
-        Dobs = np.hstack(Dobs)
-        Dunc = np.hstack(Dunc)
+        Values = np.hstack(Values)
+        Dvalues = np.hstack(Dvalues)
 
+        # the datacoders are rebuilt from these arrays using makedatacoders_from_arrays
         np.savez(HERRMETOPTIMIZEDOBSFILE,
-                 datacoder_strings=datacoder_strings,
                  Nobs=Nobs, Waves=Waves,
                  Types=Types, Modes=Modes,
-                 Freqs=Freqs, Dobs=Dobs, Dunc=Dunc)
+                 Freqs=Freqs, Values=Values, Dvalues=Dvalues,
+                 Dobs=Dobs, Dunc=Dunc)
 
     # ===============================
     if "-inv" in argv.keys():
@@ -366,20 +390,29 @@ def optimize(argv, verbose, mapkwargs):
             zflat = zmidflat = loader['zmidflat']
             Lh = loader['Lh']
             Lv = loader['Lv']
-            Mprior = loader['Mprior'].flat[:]
-            Munc = loader['Munc'].flat[:]
+            # the loaded arrays belong to us, flatten them without copy (Munc is modified in place below)
+            # the cubes are stored in single precision, the inversion runs in double precision
+            Mprior = loader['Mprior'].astype(float, copy=False).ravel()
+            Munc = loader['Munc'].astype(float, copy=False).ravel()
             damping = loader['damping']
-            parameterizer_strings = loader['parameterizer_strings']
+            if "parameterizer_header" not in loader.files or "vs_bounds" not in loader.files:
+                # files written before the parameterizer strings were replaced by a header and bounds
+                raise IOError('{} was written by an older version of this plugin, '
+                              'please rerun HerrMet --optimize -mprior'.format(HERRMETOPTIMIZEPRIORFILE))
+            parameterizer_strings = parameterizer_strings_from_bounds(
+                parameterizer_header=str(loader['parameterizer_header']),
+                vs_bounds=loader['vs_bounds'])
 
         with np.load(HERRMETOPTIMIZEDOBSFILE) as loader:
             Nobs = loader['Nobs']
-            # Waves = loader['Waves']
-            # Types = loader['Types']
-            # Modes = loader['Modes']
-            # Freqs = loader['Freqs']
             Dobs = loader['Dobs']
             Dunc = loader['Dunc']
-            datacoder_strings = loader['datacoder_strings']
+            datacoders = makedatacoders_from_arrays(
+                Nobs=Nobs,
+                waves=loader['Waves'], types=loader['Types'],
+                modes=loader['Modes'], freqs=loader['Freqs'],
+                values=loader['Values'], dvalues=loader['Dvalues'],
+                which=Datacoder_log)
 
         nx, ny, nz = len(x), len(y), len(zmid)
         nobs = len(Dobs)
@@ -411,20 +444,22 @@ def optimize(argv, verbose, mapkwargs):
 
         g = ForwardOperator(
             parameterizer_strings=parameterizer_strings,
-            datacoder_strings=datacoder_strings,
+            datacoders=datacoders,
             nx=nx, ny=ny, nz=nz, Nobs=Nobs,
+            cachefile=None if "-nocache" in argv.keys() else HERRMETOPTIMIZETHEORYSFILE,
             **mapkwargs)
 
         Dprior = g(Mprior)
-        add_to_npz(HERRMETOPTIMIZEINVFILE,
-                   Dprior=Dprior)
+        # the fields written so far, the file is loaded only once
+        inv_contents = add_to_npz(HERRMETOPTIMIZEINVFILE,
+                                  Dprior=Dprior)
 
         M0 = smoother.dot(Mprior, trunc=4.)
 
         D0 = g(M0)
-        add_to_npz(HERRMETOPTIMIZEINVFILE,
-                   M0=M0.reshape((nz, ny, nx)),
-                   D0=D0)
+        inv_contents = add_to_npz(HERRMETOPTIMIZEINVFILE, contents=inv_contents,
+                                  M0=M0.reshape((nz, ny, nx)).astype(np.float32),
+                                  D0=D0)
 
         MI = M0.copy()
         DI = D0.copy()
@@ -471,12 +506,12 @@ def optimize(argv, verbose, mapkwargs):
             data_costs.append(chi2_data)
             model_costs.append(chi2_model)
 
-            add_to_npz(HERRMETOPTIMIZEINVFILE,
-                data_costs=np.asarray(data_costs),
-                model_costs=np.asarray(model_costs),
-                total_costs=np.asarray(model_costs) + np.asarray(data_costs),
-                Msol=MI.reshape((nz, ny, nx)),
-                Dsol=DI)
+            inv_contents = add_to_npz(HERRMETOPTIMIZEINVFILE, contents=inv_contents,
+                                      data_costs=np.asarray(data_costs),
+                                      model_costs=np.asarray(model_costs),
+                                      total_costs=np.asarray(model_costs) + np.asarray(data_costs),
+                                      Msol=MI.reshape((nz, ny, nx)).astype(np.float32),
+                                      Dsol=DI)
 
             if np.abs(DM).max() <= 0.01:
                 print('convergence achieved')
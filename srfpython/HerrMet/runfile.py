@@ -241,8 +241,8 @@ class RunFile(Database):
             if n % step: continue
 
             PT = np.asarray(PT.split(','), '|S2')  # parameter type
-            PL = np.asarray(PL.split(','), int)    # parameter layer
-            PV = np.asarray(PV.split(','), float)  # parameter value
+            PL = np.fromstring(PL, dtype=int, sep=',')    # parameter layer
+            PV = np.fromstring(PV, dtype=float, sep=',')  # parameter value
             Z, VP, VS, RH = [np.zeros(NLAYER, float) for _ in range(4)]  # do not rename variables!!
             for pt, pl, pv in zip(PT, PL, PV):
                 #_ = eval(pt)  # Z, VP, VS or RH
@@ -251,9 +251,9 @@ class RunFile(Database):
 
             W = np.asarray(W.split(','), '|S1')  # waves
             T = np.asarray(T.split(','), '|S1')  # types
-            M = np.asarray(M.split(','), int)    # modes
-            F = np.asarray(F.split(','), float)  # frequency
-            DV = np.asarray(DV.split(','), float)  # dispersion value
+            M = np.fromstring(M, dtype=int, sep=',')    # modes
+            F = np.fromstring(F, dtype=float, sep=',')  # frequency
+            DV = np.fromstring(DV, dtype=float, sep=',')  # dispersion value
             DV[DV == -1.0] = np.nan #convention
 
             yield MODELID, CHAINID, WEIGHT, LLK, NLAYER, (Z, VP, VS, RH), (W, T, M, F, DV)
@@ -353,8 +353,8 @@ class RunFile(Database):
             if n % step: continue
 
             PT = np.asarray(PT.split(','), '|S2')  # parameter type
-            PL = np.asarray(PL.split(','), int)  # parameter layer
-            PV = np.asarray(PV.split(','), float)  # parameter value
+            PL = np.fromstring(PL, dtype=int, sep=',')  # parameter layer
+            PV = np.fromstring(PV, dtype=float, sep=',')  # parameter value
             Z, VP, VS, RH = [np.zeros(NLAYER, float) for _ in range(4)]  # do not rename variables!!
             for pt, pl, pv in zip(PT, PL, PV):
                 # _ = eval(pt)  # Z, VP, VS or RH
@@ -363,9 +363,9 @@ class RunFile(Database):
 
             W = np.asarray(W.split(','), '|S1')  # waves
             T = np.asarray(T.split(','), '|S1')  # types
-            M = np.asarray(M.split(','), int)  # modes
-            F = np.asarray(F.split(','), float)  # frequency
-            DV = np.asarray(DV.split(','), float)  # dispersion value
+            M = np.fromstring(M, dtype=int, sep=',')  # modes
+            F = np.fromstring(F, dtype=float, sep=',')  # frequency
+            DV = np.fromstring(DV, dtype=float, sep=',')  # dispersion value
             DV[DV == -1.0] = np.nan  # convention
 
             yield MODELID, CHAINID, WEIGHT, LLK, NLAYER, (Z, VP, VS, RH), (W, T, M, F, DV)
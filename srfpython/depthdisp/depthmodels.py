@@ -29,6 +29,57 @@ def depthspace(zbot, n):
     return z
 
 
+def stairs_index(ztop, z):
+    """
+    find the layer number of each depth z in a layered model
+    a depth located exactly on a layer top belongs to that layer (i.e. to the layer below the interface),
+    this holds for the top of the half space too : z >= ztop[-1] is in the half space
+    depths above ztop[0] are given to the first layer
+    :param ztop: top depth of each layer, sorted, including the half space,
+        or 2D array with one model per row, padded with np.inf to a common number of layers
+    :param z: 1D array, depths to locate
+    :return: array of layer numbers, between 0 and ztop.shape[-1] - 1,
+        shape (len(z),) or (len(ztop), len(z)) for a 2D ztop
+    """
+    ztop = np.asarray(ztop)
+    if ztop.ndim == 1:
+        i = np.searchsorted(ztop, z, side="right") - 1
+    else:
+        # one searchsorted for all the models, the rows are flattened with an offset per row
+        # so that the flat array remains sorted, the depths are replaced by their rank (integers)
+        # so that the offsets are exact, the padding layers (np.inf) get the highest rank
+        nmodel, nlayer = ztop.shape
+        z = np.asarray(z)
+        depths = np.unique(np.concatenate((ztop[np.isfinite(ztop)], z)))
+        offsets = (np.arange(nmodel) * (len(depths) + 1))[:, np.newaxis]
+        ztop_keys = (np.searchsorted(depths, ztop) + offsets).ravel()
+        z_keys = (np.searchsorted(depths, z) + offsets).ravel()
+        i = np.searchsorted(ztop_keys, z_keys, side="right").reshape((nmodel, len(z)))
+        i -= (np.arange(nmodel) * nlayer)[:, np.newaxis] + 1
+    return np.clip(i, 0, ztop.shape[-1] - 1)
+
+
+def stairs_interp(ztop, values, z):
+    """
+    read a layered model (piecewise constant) at depths z
+    without building the stairs arrays, see stairs_index for the convention at the layer tops
+    like depthmodel1D(ztop, values).interp(z, interpmethod="stairs") except at depths located
+    exactly on a layer top : stairs_interp always returns the layer below (ztop <= z),
+    interp compares z to zbot = ztop + thickness, which may differ from the next ztop by rounding,
+    so it returns the layer above or below depending on the rounding
+    :param ztop: top depth of each layer, sorted, including the half space,
+        or 2D array with one model per row (see stairs_index)
+    :param values: the value in each layer, same shape as ztop
+    :param z: 1D array, depths at which to read the model
+    :return: the values at depths z, shape (len(z),) or (len(ztop), len(z)) for a 2D ztop
+    """
+    values = np.asarray(values)
+    i = stairs_index(ztop, z)
+    if values.ndim == 1:
+        return values[i]
+    return values[np.arange(len(values))[:, np.newaxis], i]
+
+
 # -------------------------------------------------
 class depthmodel1D(object):
     """self.z = ztop !!!
@@ -188,7 +239,7 @@ class depthmodel1D(object):
         # values = np.array(values)
         newztop = np.concatenate((self.z, np.arange(0., self.z[-1], thickness)))
         newztop = np.round(newztop, 6)
-        newztop = np.sort(np.unique(newztop))
+        newztop = np.unique(newztop)  # sorted
 
         newvalues = self.interp(newztop+1.e-12, interpmethod="stairs")
         self.__init__(newztop, newvalues)
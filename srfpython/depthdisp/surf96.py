@@ -3,31 +3,25 @@ import numpy as np
 
 def unpacksurf96(string):
     """unpack dispersion curves at surf96 format (see Herrmann's doc)"""
-    string = [line.strip() for line in string.split('\n')]
-    if "" in string:
-        string.remove('')
-    npoints = len(string)
-
-    datatypes = ['|S1', '|S1', '|S1', int, float, float, float]
-    WAVE, TYPE, FLAG, MODE, PERIOD, VALUE, DVALUE = [np.empty(npoints, dtype=d) for d in datatypes]
-    NLC, NLU, NRC, NRU = 0, 0, 0, 0
-    for n in range(npoints):
-        l = string[n].split()
-        WAVE[n], TYPE[n], FLAG[n] = np.asarray(l[1:4], "|S1")
-        MODE[n] = int(l[4])
-        PERIOD[n], VALUE[n], DVALUE[n] = np.asarray(l[5:], float)
-        if WAVE[n] == "L":
-            if TYPE[n] == "C":
-                NLC += 1
-            elif TYPE[n] == "U":
-                NLU += 1
-        elif WAVE[n] == "R":
-            if TYPE[n] == "C":
-                NRC += 1
-            elif TYPE[n] == "U":
-                NRU += 1
-        else:
-            raise Exception('')
+    # one line per point, 8 columns : SURF96 wave type flag mode period value dvalue
+    tokens = np.asarray(string.split())
+    if tokens.size % 8:
+        raise ValueError('could not unpack surf96 string, each line must have 8 columns')
+    tokens = tokens.reshape((-1, 8))
+
+    WAVE, TYPE, FLAG = [np.asarray(tokens[:, j], '|S1') for j in (1, 2, 3)]
+    MODE = tokens[:, 4].astype(int)
+    PERIOD, VALUE, DVALUE = [tokens[:, j].astype(float) for j in (5, 6, 7)]
+
+    R = WAVE == b"R"
+    if not ((WAVE == b"L") | R).all():
+        raise Exception('')
+    U = TYPE == b"U"
+    CU = U | (TYPE == b"C")  # other types are not counted
+
+    # one code per point : LC=0, LU=1, RC=2, RU=3
+    code = R.astype(np.uint8) * 2 + U.astype(np.uint8)
+    NLC, NLU, NRC, NRU = [int(_) for _ in np.bincount(code[CU], minlength=4)]
     return WAVE, TYPE, FLAG, MODE, PERIOD, VALUE, DVALUE, NLC, NLU, NRC, NRU
 
 